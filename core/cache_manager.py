@@ -1,12 +1,18 @@
 """
 Simple caching system for image captions
 """
-import hashlib
-import json
 import os
+import sqlite3
+import threading
+import time
+import orjson
 from pathlib import Path
-from datetime import datetime, timedelta
-from typing import Optional, Dict
+from datetime import timedelta
+from typing import Optional, Dict, Tuple
+
+CACHE_TTL = timedelta(days=30)
+# Buffered entries are written once this many pile up, so a long batch stays bounded
+FLUSH_EVERY = 100
 
 
 class CaptionCache:
@@ -15,78 +21,112 @@ class CaptionCache:
     def __init__(self, cache_dir: str = "data/cache"):
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
-        self.metadata_file = self.cache_dir / "metadata.json"
-        self.metadata = self._load_metadata()
+        self.db_file = self.cache_dir / "captions.db"
+        self._lock = threading.Lock()
+        self._batch_depth = 0
+        self._pending: Dict[str, Tuple[int, bytes]] = {}
+        
+        # One database file instead of a JSON file per image; WAL keeps commits cheap
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache("
+            "key TEXT PRIMARY KEY, cached_at INT, payload BLOB)"
+        )
+        self._conn.commit()
+    
+    def __enter__(self) -> "CaptionCache":
+        """Buffer writes until the batch exits"""
+        with self._lock:
+            self._batch_depth += 1
+        return self
     
-    def _load_metadata(self) -> Dict:
-        """Load cache metadata"""
-        if self.metadata_file.exists():
-            with open(self.metadata_file, "r") as f:
-                return json.load(f)
-        return {}
+    def __exit__(self, exc_type, exc, tb):
+        with self._lock:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._flush()
     
-    def _save_metadata(self):
-        """Save cache metadata"""
-        with open(self.metadata_file, "w") as f:
-            json.dump(self.metadata, f, indent=2)
+    def _flush(self):
+        """Write buffered entries in one transaction (caller holds the lock)"""
+        if not self._pending:
+            return
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO cache(key, cached_at, payload) VALUES (?, ?, ?)",
+            [(key, cached_at, payload) for key, (cached_at, payload) in self._pending.items()]
+        )
+        self._conn.commit()
+        self._pending.clear()
     
-    def _get_file_hash(self, file_path: str) -> str:
-        """Generate hash of file for cache key"""
-        stat = os.stat(file_path)
-        # Use size and modification time for quick hash
-        return hashlib.md5(f"{file_path}_{stat.st_size}_{stat.st_mtime}".encode()).hexdigest()
+    def _get_file_hash(self, file_path: str, st: Optional[os.stat_result] = None) -> str:
+        """Generate cache key from file identity and signature"""
+        # Callers that already scanned the directory pass their stat result along
+        stat = st or os.stat(file_path)
+        # Device + inode identify the file, size + mtime detect changes; no hashing needed
+        return f"{stat.st_dev}_{stat.st_ino}_{stat.st_size}_{stat.st_mtime_ns}"
     
-    def get(self, image_path: str) -> Optional[Dict]:
+    def get(self, image_path: str, st: Optional[os.stat_result] = None) -> Optional[Dict]:
         """Retrieve cached caption if valid"""
         try:
-            file_hash = self._get_file_hash(image_path)
-            cache_file = self.cache_dir / f"{file_hash}.json"
+            file_hash = self._get_file_hash(image_path, st)
+            with self._lock:
+                row = self._pending.get(file_hash)
+                if row is None:
+                    row = self._conn.execute(
+                        "SELECT cached_at, payload FROM cache WHERE key = ?", (file_hash,)
+                    ).fetchone()
             
-            if cache_file.exists():
+            if row is not None:
+                cached_at, payload = row
                 # Check if cache is still valid (e.g., less than 30 days old)
-                cache_age = datetime.now() - datetime.fromtimestamp(cache_file.stat().st_mtime)
-                if cache_age < timedelta(days=30):
-                    with open(cache_file, "r") as f:
-                        return json.load(f)
+                if time.time() - cached_at < CACHE_TTL.total_seconds():
+                    return orjson.loads(payload)
         except Exception as e:
             print(f"Cache read error: {e}")
         return None
     
-    def set(self, image_path: str, caption: Dict):
+    def set(self, image_path: str, caption: Dict, st: Optional[os.stat_result] = None):
         """Store caption in cache"""
         try:
-            file_hash = self._get_file_hash(image_path)
-            cache_file = self.cache_dir / f"{file_hash}.json"
+            file_hash = self._get_file_hash(image_path, st)
+            entry = (int(time.time()), orjson.dumps(caption))
             
-            with open(cache_file, "w") as f:
-                json.dump(caption, f, indent=2)
-            
-            # Update metadata
-            self.metadata[image_path] = {
-                "hash": file_hash,
-                "cached_at": datetime.now().isoformat()
-            }
-            self._save_metadata()
+            # Inside a batch the insert is deferred to __exit__ or the next full buffer
+            with self._lock:
+                self._pending[file_hash] = entry
+                if self._batch_depth == 0 or len(self._pending) >= FLUSH_EVERY:
+                    self._flush()
         except Exception as e:
             print(f"Cache write error: {e}")
     
+    def close(self):
+        """Write any buffered entries and close the database"""
+        with self._lock:
+            self._flush()
+            self._conn.close()
+    
     def clear(self):
         """Clear all cache"""
+        with self._lock:
+            self._pending.clear()
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+        # Remove entries left over from the old one-file-per-image layout
         for cache_file in self.cache_dir.glob("*.json"):
             cache_file.unlink()
-        self.metadata = {}
-        self._save_metadata()
         print("✅ Cache cleared")
     
     def stats(self) -> Dict:
         """Get cache statistics"""
-        cache_files = list(self.cache_dir.glob("*.json"))
-        cache_files = [f for f in cache_files if f.name != "metadata.json"]
+        with self._lock:
+            cached_items, = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
         
-        total_size = sum(f.stat().st_size for f in cache_files)
+        db_files = [self.db_file, self.cache_dir / "captions.db-wal"]
+        total_size = sum(f.stat().st_size for f in db_files if f.exists())
         
         return {
-            "cached_items": len(cache_files),
+            "cached_items": cached_items,
             "total_size_mb": total_size / (1024 * 1024),
             "cache_dir": str(self.cache_dir)
-        }
+        }
\ No newline at end of file
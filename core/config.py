@@ -1,23 +1,34 @@
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
+from functools import cached_property
 import pydantic
 import yaml
 import os
 
 load_dotenv()
 
+# libyaml C loader when available, pure-Python fallback otherwise
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 class Settings(BaseSettings):
     model_name: str = "qwen2.5vl:7b"
+    # How long Ollama keeps the model loaded between requests
+    ollama_keep_alive: str = "10m"
+    # Hugging Face model used by the in-process vLLM backend
+    vllm_model_name: str = "Qwen/Qwen2.5-VL-7B-Instruct"
+    # Long-side pixel cap for images sent to the model (0 = send originals)
+    max_image_side: int = 1280
     
-    @property
+    @cached_property
     def prompt(self) -> str:
         # Get path relative to the project root
         config_dir = os.path.dirname(os.path.dirname(__file__))
         prompt_path = os.path.join(config_dir, "prompt.yaml")
         with open(prompt_path, "r") as f:
-            return str(yaml.safe_load(f))
+            # Parsed once per Settings instance; the stringified dict is the prompt text
+            return str(yaml.load(f, Loader=_YamlLoader))
 
     class Config:
         env_file = ".env"
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
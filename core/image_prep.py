@@ -0,0 +1,23 @@
+'''
+Image preparation shared by the Ollama and vLLM backends
+'''
+from PIL import Image, ImageOps
+from .config import settings
+
+MAX_IMAGE_SIDE: int = settings.max_image_side
+
+def prepare_image(img: Image.Image) -> Image.Image:
+    """Upright RGB copy of img with its long side capped at MAX_IMAGE_SIDE (0 = no cap)"""
+    if MAX_IMAGE_SIDE:
+        # JPEGs decode at a reduced DCT scale instead of full resolution
+        img.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    # Bake EXIF orientation into the pixels so both backends see the same upright image
+    image = ImageOps.exif_transpose(img)
+    if "A" in image.getbands() or image.info.get("transparency") is not None:
+        # A plain RGB convert turns transparent areas black; put them on white instead
+        rgba = image.convert("RGBA")
+        image = Image.alpha_composite(Image.new("RGBA", rgba.size, "white"), rgba)
+    image = image.convert("RGB")
+    if MAX_IMAGE_SIDE:
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    return image
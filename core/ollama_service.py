@@ -1,22 +1,42 @@
 '''
 Enhanced Ollama VLM Captioning Service with health checks
 '''
+import io
+import os
+import asyncio
 import time
+import mmap
+import base64
+import threading
+import httpx
 import requests
-from typing import Optional
-from ollama import generate
+from typing import BinaryIO, Optional
+from collections import OrderedDict
+from contextlib import contextmanager
+from ollama import Client
+from PIL import Image
 from .config import settings
+from .image_prep import MAX_IMAGE_SIDE, prepare_image
 from functools import lru_cache
 
 MODEL: str = settings.model_name
 PROMPT: str = settings.prompt
+OLLAMA_HOST: str = "http://localhost:11434"
+KEEP_ALIVE: str = settings.ollama_keep_alive
+GENERATE_OPTIONS: dict = {
+    "temperature": 0.7,  # Lower for more consistent outputs
+    "num_predict": 512,  # Limit output length
+}
+
+# One client for the process so the sync path reuses its HTTP connection
+_client = Client(host=OLLAMA_HOST, timeout=httpx.Timeout(60.0))
 
 @lru_cache(maxsize=1)
 def check_ollama_status() -> tuple[bool, str]:
     """Check if Ollama is running and model is available"""
     try:
         # Check if Ollama is running
-        response = requests.get("http://localhost:11434/api/tags", timeout=5)
+        response = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=5)
         if response.status_code != 200:
             return False, "Ollama is not running. Start with: ollama serve"
         
@@ -33,51 +53,144 @@ def check_ollama_status() -> tuple[bool, str]:
     except Exception as e:
         return False, f"Error checking Ollama: {e}"
 
-def read_image(file_path: str, max_size_mb: int = 10) -> Optional[bytes]:
-    """Read image with size validation"""
+# Recent downscale results, keyed by (path, mtime_ns, size) so retries skip the decode
+_DOWNSCALE_CACHE_SIZE = 32
+_downscale_cache: "OrderedDict[tuple, Optional[str]]" = OrderedDict()
+_downscale_lock = threading.Lock()
+
+def _downscale_image(f: BinaryIO) -> Optional[str]:
+    """Re-encode oversized or EXIF-rotated images as an upright JPEG (None to send as-is)"""
+    with Image.open(f) as img:
+        # Small images still need re-encoding when their pixels aren't stored upright
+        if max(img.size) <= MAX_IMAGE_SIDE and img.getexif().get(0x0112, 1) == 1:
+            return None
+        # Re-encoding drops EXIF; prepare_image bakes the orientation into the pixels
+        buf = io.BytesIO()
+        prepare_image(img).save(buf, "JPEG", quality=88)
+    return base64.b64encode(buf.getbuffer()).decode()
+
+def _cached_downscale(key: tuple, f: BinaryIO) -> Optional[str]:
+    with _downscale_lock:
+        if key in _downscale_cache:
+            _downscale_cache.move_to_end(key)
+            return _downscale_cache[key]
+    
     try:
-        # Check file size
-        import os
-        file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-        if file_size_mb > max_size_mb:
-            print(f"⚠️ Image {file_path} is large ({file_size_mb:.1f}MB)")
+        downscaled = _downscale_image(f)
+    except Exception:
+        downscaled = None  # Not decodable by PIL; let Ollama handle the original
+    
+    with _downscale_lock:
+        _downscale_cache[key] = downscaled
+        if len(_downscale_cache) > _DOWNSCALE_CACHE_SIZE:
+            _downscale_cache.popitem(last=False)
+    return downscaled
+
+@contextmanager
+def _sequential_read(f: BinaryIO):
+    """Hint a single sequential pass over f, then drop its pages (no-ops where unsupported)"""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        yield
+    finally:
+        # Each image is read once per run, so don't let thousands of them crowd the page cache
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def read_image(file_path: str, max_size_mb: int = 10,
+               st: Optional[os.stat_result] = None) -> Optional[str]:
+    """Read image with size validation, returned base64-encoded for the Ollama API"""
+    try:
+        with open(file_path, 'rb') as f, _sequential_read(f):
+            # One stat (from the caller's directory scan, or fstat) serves the size check
+            st = st or os.fstat(f.fileno())
+            file_size = st.st_size
+            file_size_mb = file_size / (1024 * 1024)
+            if file_size_mb > max_size_mb:
+                print(f"⚠️ Image {file_path} is large ({file_size_mb:.1f}MB)")
+            if file_size == 0:
+                return None
             
-        with open(file_path, 'rb') as f:
-            return f.read()
+            # Send oversized images at the model's working resolution instead of raw
+            if MAX_IMAGE_SIDE:
+                downscaled = _cached_downscale((file_path, st.st_mtime_ns, file_size), f)
+                if downscaled is not None:
+                    return downscaled
+            
+            # Encode straight from the page cache instead of copying into a bytes object first
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return base64.b64encode(mm).decode()
     except Exception as e:
         print(f"❌ Error reading {file_path}: {e}")
         return None
 
-def get_caption(img_path: str, timeout: int = 30) -> str:
-    """Get caption with health checks and timeout protection"""
-    # Check Ollama status first
+def ensure_ollama_ready():
+    """Raise ConnectionError unless Ollama is up with the model pulled"""
     is_ready, message = check_ollama_status()
     if not is_ready:
         raise ConnectionError(message)
+
+def get_caption(img_path: str, timeout: int = 30, check_status: bool = True,
+                st: Optional[os.stat_result] = None) -> str:
+    """Get caption with health checks and timeout protection"""
+    # Batch callers check once up front and pass check_status=False
+    if check_status:
+        ensure_ollama_ready()
     
-    img_data = read_image(img_path)
+    img_data = read_image(img_path, st=st)
     if not img_data:
         raise ValueError(f"Could not read image: {img_path}")
     
-    res = ''
+    chunks: list[str] = []
     start_time = time.time()
     
     try:
-        for response in generate(
+        for response in _client.generate(
             model=MODEL,
             prompt=PROMPT,
             images=[img_data],
             stream=True,
-            options={
-                "temperature": 0.7,  # Lower for more consistent outputs
-                "num_predict": 512,  # Limit output length
-            }
+            options=GENERATE_OPTIONS,
+            keep_alive=KEEP_ALIVE,
         ):
             if time.time() - start_time > timeout:
                 raise TimeoutError(f"Caption generation exceeded {timeout}s")
-            res += response['response']
+            chunks.append(response['response'])
+    except Exception as e:
+        print(f"❌ Error during generation: {e}")
+        raise
+    
+    return ''.join(chunks)
+
+async def get_caption_async(client: httpx.AsyncClient, img_path: str, timeout: int = 30,
+                            st: Optional[os.stat_result] = None) -> str:
+    """Get caption over a shared async client (connection pool reused across images)"""
+    # Reading and downscaling are blocking; keep them off the event loop
+    img_data = await asyncio.to_thread(read_image, img_path, st=st)
+    if not img_data:
+        raise ValueError(f"Could not read image: {img_path}")
+    
+    try:
+        response = await client.post(
+            f"{OLLAMA_HOST}/api/generate",
+            json={
+                "model": MODEL,
+                "prompt": PROMPT,
+                "images": [img_data],
+                "stream": False,  # Single response instead of per-token chunks
+                "options": GENERATE_OPTIONS,
+                "keep_alive": KEEP_ALIVE,
+            },
+            timeout=timeout,
+        )
+        response.raise_for_status()
+    except httpx.TimeoutException:
+        raise TimeoutError(f"Caption generation exceeded {timeout}s")
     except Exception as e:
         print(f"❌ Error during generation: {e}")
         raise
     
-    return res
+    return response.json()['response']
@@ -1,50 +1,106 @@
 import os
-import re
-import json
+import orjson
 import kagglehub
 import random
-import concurrent.futures
-import time
+import textwrap
+from collections import deque
+import asyncio
+import httpx
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Any
 from tqdm import tqdm
-from .ollama_service import get_caption
-from matplotlib import pyplot as plt
+from .ollama_service import get_caption, get_caption_async, ensure_ollama_ready
+from .vllm_service import get_captions_batch
+from .cache_manager import CaptionCache
+from PIL import Image, ImageDraw, ImageFont
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+DEMO_DIR = "data/demo"
 
 def get_image_files(directory: str) -> list[str]:
-    return [f for f in os.listdir(directory) if f.endswith(('.png', '.jpg', '.jpeg'))]
+    with os.scandir(directory) as entries:
+        return [e.name for e in entries if e.name.endswith(IMAGE_EXTENSIONS) and e.is_file()]
+
+def stat_images(image_files: list[str], root: str) -> Dict[str, os.stat_result]:
+    """Stat each image once, to be reused for cache keys and image reads"""
+    stats = {}
+    for f in image_files:
+        try:
+            stats[f] = os.stat(f"{root}/{f}")
+        except OSError:
+            continue  # Left out so the image fails on its own when it is read
+    return stats
+
+# When one name exists with several extensions, the earliest listed wins
+_INDEX_PRIORITY = ('.jpg', '.jpeg', '.png')
+
+def _index_priority(image_file: str) -> int:
+    # Names splitext can't split (e.g. a bare ".png") sort last instead of raising
+    ext = os.path.splitext(image_file)[1]
+    return _INDEX_PRIORITY.index(ext) if ext in _INDEX_PRIORITY else len(_INDEX_PRIORITY)
+
+def index_images(image_files: list[str], root: str) -> Dict[str, str]:
+    """Map each image's name (without extension) to its path under root"""
+    index: Dict[str, str] = {}
+    for f in sorted(image_files, key=_index_priority):
+        index.setdefault(os.path.splitext(f)[0], f"{root}/{f}")
+    return index
+
+def get_caption_stems(directory: str) -> set[str]:
+    """Names (without extension) of the JSON captions already in directory"""
+    with os.scandir(directory) as entries:
+        return {os.path.splitext(e.name)[0] for e in entries
+                if e.name.endswith('.json') and e.is_file()}
+
+def strip_json_fence(text: str) -> str:
+    """Strip a leading ```/```json and trailing ``` markdown fence from model output"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:]
+        if text.startswith("json"):
+            text = text[4:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
 
 def get_dummy_images_from_kaggle() -> str:
     path = kagglehub.dataset_download("lprdosmil/unsplash-random-images-collection")
     return path
 
-def process_single_image(args: Tuple[str, str]) -> Tuple[str, Optional[Dict]]:
+async def process_single_image(client: httpx.AsyncClient,
+                               semaphore: asyncio.Semaphore,
+                               img_path: str,
+                               root: str,
+                               cache: Optional[CaptionCache] = None,
+                               st: Optional[os.stat_result] = None) -> Tuple[str, Optional[Dict]]:
     """Process a single image with error handling and retry logic"""
-    img_path, root = args
+    full_path = f"{root}/{img_path}"
+    if cache is not None:
+        cached = cache.get(full_path, st)
+        if cached is not None:
+            return img_path, cached
+    
     max_retries = 3
     
     for attempt in range(max_retries):
         try:
-            result = get_caption(f"{root}/{img_path}")
+            async with semaphore:
+                result = await get_caption_async(client, full_path, st=st)
             
-            # More robust JSON extraction
-            result = result.strip()
-            # Handle various markdown formats
-            result = re.sub(r'^```(?:json)?\s*\n?', '', result)
-            result = re.sub(r'\n?```\s*$', '', result)
-            
-            caption = json.loads(result)
+            caption = orjson.loads(strip_json_fence(result))
+            if cache is not None:
+                cache.set(full_path, caption, st)
             return img_path, caption
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             if attempt < max_retries - 1:
-                time.sleep(1)  # Brief pause before retry
+                await asyncio.sleep(1)  # Brief pause before retry
                 continue
             print(f"\n❌ JSON decode error for {img_path}: {e}")
             return img_path, None
         except Exception as e:
             if attempt < max_retries - 1:
-                time.sleep(1)
+                await asyncio.sleep(1)
                 continue
             print(f"\n❌ Error processing {img_path}: {e}")
             return img_path, None
@@ -52,30 +108,31 @@ def process_single_image(args: Tuple[str, str]) -> Tuple[str, Optional[Dict]]:
     return img_path, None
 
 def map_captions(image_files: list[str],
-                 root: str) -> None:
+                 root: str,
+                 cache: Optional[CaptionCache] = None,
+                 stats: Optional[Dict[str, os.stat_result]] = None) -> None:
     """Original sequential processing with improved error handling"""
     os.makedirs("data/captions", exist_ok=True)
+    ensure_ollama_ready()
     failed_images = []
     
     for img_path in tqdm(image_files, 
                          desc="Mapping Captions", 
                          total=len(image_files)):
         try:
-            result = get_caption(f"{root}/{img_path}")
-            
-            # More robust cleaning
-            result = result.strip()
-            result = re.sub(r"^```(?:json)?\s*", "", result)
-            result = re.sub(r"\s*```$", "", result)
-            
-            caption = json.loads(result)
-            name = img_path.split(".")[0]
+            full_path = f"{root}/{img_path}"
+            st = stats.get(img_path) if stats else None
+            caption = cache.get(full_path, st) if cache is not None else None
+            if caption is None:
+                result = get_caption(full_path, check_status=False, st=st)
+                caption = orjson.loads(strip_json_fence(result))
+                if cache is not None:
+                    cache.set(full_path, caption, st)
+            name = os.path.splitext(img_path)[0]
             
-            # Use context manager for proper file handling
-            with open(f"data/captions/{name}.json", "w") as f:
-                json.dump(caption, f, indent=4)
+            _save_caption(f"data/captions/{name}.json", caption)
                 
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"\n❌ Failed to parse JSON for {img_path}: {e}")
             failed_images.append(img_path)
         except Exception as e:
@@ -87,36 +144,127 @@ def map_captions(image_files: list[str],
 
 def map_captions_parallel(image_files: List[str], 
                          root: str, 
-                         max_workers: int = 4) -> Dict[str, Any]:
-    """Process images in parallel for much faster performance"""
+                         max_workers: int = 4,
+                         cache: Optional[CaptionCache] = None,
+                         stats: Optional[Dict[str, os.stat_result]] = None) -> Dict[str, Any]:
+    """Process images concurrently over one pooled async HTTP client"""
+    # A zero-count semaphore would block every request forever
+    if max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, got {max_workers}")
     os.makedirs("data/captions", exist_ok=True)
     
-    # Prepare arguments for parallel processing
-    args_list = [(img_path, root) for img_path in image_files]
+    # Check Ollama once up front instead of per image
+    ensure_ollama_ready()
+    
+    return asyncio.run(_run_captions(image_files, root, max_workers, cache, stats or {}))
+
+async def _run_captions(image_files: List[str],
+                        root: str,
+                        max_workers: int,
+                        cache: Optional[CaptionCache],
+                        stats: Dict[str, os.stat_result]) -> Dict[str, Any]:
+    # Semaphore bounds in-flight requests; the pool keeps connections alive between them
+    semaphore = asyncio.Semaphore(max_workers)
+    limits = httpx.Limits(max_connections=max_workers, max_keepalive_connections=max_workers)
+    results: asyncio.Queue = asyncio.Queue()
     
+    async with httpx.AsyncClient(limits=limits) as client:
+        async def produce(img_path: str):
+            await results.put(await process_single_image(client, semaphore, img_path, root, cache,
+                                                         stats.get(img_path)))
+        
+        writer = asyncio.create_task(_write_captions(results, len(image_files)))
+        await asyncio.gather(*(produce(img_path) for img_path in image_files))
+    
+    return await writer
+
+async def _write_captions(results: asyncio.Queue, total: int) -> Dict[str, Any]:
+    """Consume parsed captions and write them off the event loop"""
     successful = 0
     failed = []
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        futures = {executor.submit(process_single_image, args): args[0] 
-                  for args in args_list}
+    # Process results with progress bar
+    with tqdm(total=total, desc="Processing images in parallel") as pbar:
+        for _ in range(total):
+            img_path, caption = await results.get()
+            
+            if caption:
+                # Save caption
+                name = os.path.splitext(img_path)[0]
+                await asyncio.to_thread(_save_caption, f"data/captions/{name}.json", caption)
+                successful += 1
+            else:
+                failed.append(img_path)
+            
+            pbar.update(1)
+    
+    print(f"\n✅ Successfully processed: {successful}/{total}")
+    if failed:
+        print(f"❌ Failed: {len(failed)} images")
+    
+    return {"successful": successful, "failed": failed}
+
+def map_captions_batched(image_files: List[str],
+                         root: str,
+                         batch_size: int = 8,
+                         cache: Optional[CaptionCache] = None,
+                         stats: Optional[Dict[str, os.stat_result]] = None) -> Dict[str, Any]:
+    """Caption images in fixed-size batches through the in-process vLLM backend"""
+    # An empty batch never drains the pending queue
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+    os.makedirs("data/captions", exist_ok=True)
+    stats = stats or {}
+    max_retries = 3
+    
+    successful = 0
+    failed = []
+    
+    with tqdm(total=len(image_files), desc="Processing images in batches") as pbar:
+        # Cache hits are written straight away; only misses go to the model
+        pending = deque()
+        for img_path in image_files:
+            cached = cache.get(f"{root}/{img_path}", stats.get(img_path)) if cache is not None else None
+            if cached is not None:
+                _save_caption(f"data/captions/{os.path.splitext(img_path)[0]}.json", cached)
+                successful += 1
+                pbar.update(1)
+            else:
+                pending.append((img_path, 0))
         
-        # Process results with progress bar
-        with tqdm(total=len(image_files), desc="Processing images in parallel") as pbar:
-            for future in concurrent.futures.as_completed(futures):
-                img_path, caption = future.result()
-                
-                if caption:
-                    # Save caption
-                    name = img_path.split(".")[0]
-                    caption_path = f"data/captions/{name}.json"
-                    with open(caption_path, "w") as f:
-                        json.dump(caption, f, indent=4)
-                    successful += 1
-                else:
+        while pending:
+            batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+            
+            try:
+                results = get_captions_batch([f"{root}/{img_path}" for img_path, _ in batch])
+            except Exception as e:
+                print(f"\n❌ Error processing batch starting at {batch[0][0]}: {e}")
+                failed.extend(img_path for img_path, _ in batch)
+                pbar.update(len(batch))
+                continue
+            
+            for (img_path, attempt), result in zip(batch, results):
+                if result is None:
+                    # Unreadable image; get_captions_batch already reported it
+                    failed.append(img_path)
+                    pbar.update(1)
+                    continue
+                try:
+                    caption = orjson.loads(strip_json_fence(result))
+                except orjson.JSONDecodeError as e:
+                    if attempt < max_retries - 1:
+                        # Malformed output is re-generated in a later batch
+                        pending.append((img_path, attempt + 1))
+                        continue
+                    print(f"\n❌ JSON decode error for {img_path}: {e}")
                     failed.append(img_path)
+                    pbar.update(1)
+                    continue
                 
+                if cache is not None:
+                    cache.set(f"{root}/{img_path}", caption, stats.get(img_path))
+                _save_caption(f"data/captions/{os.path.splitext(img_path)[0]}.json", caption)
+                successful += 1
                 pbar.update(1)
     
     print(f"\n✅ Successfully processed: {successful}/{len(image_files)}")
@@ -125,7 +273,82 @@ def map_captions_parallel(image_files: List[str],
     
     return {"successful": successful, "failed": failed}
 
-def make_demo(data_dir: str, caption_dir: str):
+def _save_caption(caption_path: str, caption: Dict):
+    """Serialize once and write with a raw fd, bypassing Python's buffered IO"""
+    data = memoryview(orjson.dumps(caption, option=orjson.OPT_INDENT_2))
+    fd = os.open(caption_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Usually a single write; loop only in case the kernel accepts a partial write
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+def _load_font(names: Tuple[str, ...], size: int) -> ImageFont.FreeTypeFont:
+    for font_name in names:
+        try:
+            return ImageFont.truetype(font_name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+def _wrap_lines(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> str:
+    """Wrap lines wider than max_width, continuing them under their own indentation"""
+    columns = max(1, int(max_width // font.getlength("M")))
+    wrapped = []
+    for line in text.splitlines():
+        if font.getlength(line) <= max_width:
+            wrapped.append(line)
+            continue
+        indent = " " * (len(line) - len(line.lstrip()) + 2)
+        wrapped.extend(textwrap.wrap(line, width=columns, subsequent_indent=indent))
+    return "\n".join(wrapped)
+
+def _render_demo(image_file: str, caption_path: str, name: str, demo_path: str, font_size: int):
+    """Render image on the left and its full JSON caption on the right into one PNG"""
+    # Load caption
+    with open(caption_path, "rb") as f:
+        caption_data = orjson.loads(f.read())
+    
+    # Create formatted JSON string
+    json_caption = orjson.dumps(caption_data, option=orjson.OPT_INDENT_2).decode()
+    
+    title_font = _load_font(("DejaVuSans.ttf", "Arial.ttf"), 20)
+    text_font = _load_font(("DejaVuSansMono.ttf", "Menlo.ttc", "Consolas.ttf"), font_size)
+    
+    panel, margin, title_height = 800, 20, 40
+    # Box sits in the right panel with a margin outside and inside it
+    json_caption = _wrap_lines(json_caption, text_font, panel - 4 * margin)
+    measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox((0, 0), json_caption, font=text_font)
+    height = max(panel, title_height + bottom - top + 4 * margin)
+    
+    canvas = Image.new("RGB", (2 * panel, height), "white")
+    draw = ImageDraw.Draw(canvas)
+    
+    # Left side - Image
+    with Image.open(image_file) as img:
+        img = img.convert("RGB")
+        img.thumbnail((panel - 2 * margin, panel - title_height - 2 * margin))
+        canvas.paste(img, ((panel - img.width) // 2, title_height + margin))
+    draw.text((panel // 2, margin), f"Image: {name}", font=title_font, fill="black", anchor="mt")
+    
+    # Right side - JSON Caption
+    draw.text((panel + panel // 2, margin), "JSON Caption", font=title_font, fill="black", anchor="mt")
+    box_origin = (panel + margin, title_height + margin)
+    draw.rounded_rectangle(
+        (box_origin[0], box_origin[1],
+         box_origin[0] + right - left + 2 * margin,
+         box_origin[1] + bottom - top + 2 * margin),
+        radius=10, fill="lightgray")
+    draw.multiline_text((box_origin[0] + margin, box_origin[1] + margin), json_caption,
+                        font=text_font, fill="black")
+    
+    # Save demo (callers create DEMO_DIR once up front)
+    canvas.save(demo_path, optimize=True)
+
+def make_demo(data_dir: str, caption_dir: str,
+              image_index: Optional[Dict[str, str]] = None):
     """Generate demo visualization with image on left and full JSON caption on right"""
     random.seed(42)
     
@@ -135,68 +358,32 @@ def make_demo(data_dir: str, caption_dir: str):
         print("❌ No caption files found for demo")
         return
     
+    # One directory scan resolves every caption's image
+    if image_index is None:
+        image_index = index_images(get_image_files(data_dir), data_dir)
+    
     # Pick a random caption file
     i = random.randint(0, len(caption_files) - 1)
     caption_file = caption_files[i]
-    name = caption_file.split(".")[0]
+    name = os.path.splitext(caption_file)[0]
     
     # Find corresponding image file
-    image_extensions = ['.jpg', '.jpeg', '.png']
-    image_file = None
-    for ext in image_extensions:
-        potential_path = f"{data_dir}/{name}{ext}"
-        if os.path.exists(potential_path):
-            image_file = potential_path
-            break
-    
+    image_file = image_index.get(name)
     if not image_file:
         print(f"❌ No image found for caption {caption_file}")
         return
     
     try:
-        # Load caption
-        with open(f"{caption_dir}/{caption_file}", "r") as f:
-            caption_data = json.load(f)
-        
-        # Create formatted JSON string
-        json_caption = json.dumps(caption_data, indent=2, ensure_ascii=False)
-        
-        # Create figure with two subplots (side by side)
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 8))
-        
-        # Left side - Image
-        img = plt.imread(image_file)
-        ax1.imshow(img)
-        ax1.set_title(f"Image: {name}", fontsize=14, pad=20)
-        ax1.axis('off')
-        
-        # Right side - JSON Caption
-        ax2.text(0.05, 0.95, json_caption, 
-                transform=ax2.transAxes,
-                fontsize=10,
-                verticalalignment='top',
-                horizontalalignment='left',
-                fontfamily='monospace',
-                bbox=dict(boxstyle="round,pad=0.5", facecolor="lightgray", alpha=0.8))
-        ax2.set_title("JSON Caption", fontsize=14, pad=20)
-        ax2.axis('off')
-        
-        # Adjust layout
-        plt.tight_layout()
-        
-        # Save demo
-        os.makedirs("data/demo", exist_ok=True)
-        demo_path = f"data/demo/{name}_demo.png"
-        plt.savefig(demo_path, bbox_inches='tight', dpi=150)
-        plt.close()
-        
+        os.makedirs(DEMO_DIR, exist_ok=True)
+        demo_path = f"{DEMO_DIR}/{name}_demo.png"
+        _render_demo(image_file, f"{caption_dir}/{caption_file}", name, demo_path, font_size=14)
         print(f"✅ Demo saved to {demo_path}")
         
     except Exception as e:
         print(f"❌ Error creating demo: {e}")
-        plt.close()
 
-def make_multiple_demos(data_dir: str, caption_dir: str, num_demos: int = 3):
+def make_multiple_demos(data_dir: str, caption_dir: str, num_demos: int = 3,
+                        image_index: Optional[Dict[str, str]] = None):
     """Generate multiple demo visualizations"""
     random.seed(42)
     
@@ -206,65 +393,28 @@ def make_multiple_demos(data_dir: str, caption_dir: str, num_demos: int = 3):
         print("❌ No caption files found for demo")
         return
     
+    # One directory scan resolves every caption's image
+    if image_index is None:
+        image_index = index_images(get_image_files(data_dir), data_dir)
+    
     # Generate multiple demos
     num_demos = min(num_demos, len(caption_files))
     selected_files = random.sample(caption_files, num_demos)
+    os.makedirs(DEMO_DIR, exist_ok=True)
     
     for idx, caption_file in enumerate(selected_files):
-        name = caption_file.split(".")[0]
+        name = os.path.splitext(caption_file)[0]
         
         # Find corresponding image file
-        image_extensions = ['.jpg', '.jpeg', '.png']
-        image_file = None
-        for ext in image_extensions:
-            potential_path = f"{data_dir}/{name}{ext}"
-            if os.path.exists(potential_path):
-                image_file = potential_path
-                break
-        
+        image_file = image_index.get(name)
         if not image_file:
             print(f"❌ No image found for caption {caption_file}")
             continue
         
         try:
-            # Load caption
-            with open(f"{caption_dir}/{caption_file}", "r") as f:
-                caption_data = json.load(f)
-            
-            # Create formatted JSON string
-            json_caption = json.dumps(caption_data, indent=2, ensure_ascii=False)
-            
-            # Create figure with two subplots (side by side)
-            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 8))
-            
-            # Left side - Image
-            img = plt.imread(image_file)
-            ax1.imshow(img)
-            ax1.set_title(f"Image: {name}", fontsize=14, pad=20)
-            ax1.axis('off')
-            
-            # Right side - JSON Caption
-            ax2.text(0.05, 0.95, json_caption, 
-                    transform=ax2.transAxes,
-                    fontsize=9,
-                    verticalalignment='top',
-                    horizontalalignment='left',
-                    fontfamily='monospace',
-                    bbox=dict(boxstyle="round,pad=0.5", facecolor="lightgray", alpha=0.8))
-            ax2.set_title("JSON Caption", fontsize=14, pad=20)
-            ax2.axis('off')
-            
-            # Adjust layout
-            plt.tight_layout()
-            
-            # Save demo
-            os.makedirs("data/demo", exist_ok=True)
-            demo_path = f"data/demo/{name}_demo_{idx+1}.png"
-            plt.savefig(demo_path, bbox_inches='tight', dpi=150)
-            plt.close()
-            
+            demo_path = f"{DEMO_DIR}/{name}_demo_{idx+1}.png"
+            _render_demo(image_file, f"{caption_dir}/{caption_file}", name, demo_path, font_size=13)
             print(f"✅ Demo {idx+1} saved to {demo_path}")
             
         except Exception as e:
             print(f"❌ Error creating demo {idx+1}: {e}")
-            plt.close()
\ No newline at end of file
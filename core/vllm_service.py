@@ -0,0 +1,60 @@
+'''
+Batched in-process Qwen2.5-VL captioning through vLLM (optional backend)
+'''
+from functools import lru_cache
+from typing import Optional
+from PIL import Image
+from .config import settings
+from .image_prep import prepare_image
+
+VLLM_MODEL: str = settings.vllm_model_name
+PROMPT: str = settings.prompt
+
+# Qwen2.5-VL chat template with a single image placeholder
+_PROMPT_TEMPLATE: str = (
+    "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n"
+    "<|im_start|>user\n<|vision_start|><|image_pad|><|vision_end|>"
+    "{prompt}<|im_end|>\n"
+    "<|im_start|>assistant\n"
+)
+
+@lru_cache(maxsize=1)
+def _load_model():
+    """Load the model once per process; vllm is only imported when this backend is used"""
+    try:
+        from vllm import LLM, SamplingParams
+    except ImportError as e:
+        raise ImportError("vLLM backend not installed. Install with: pip install vllm") from e
+
+    llm = LLM(model=VLLM_MODEL, limit_mm_per_prompt={"image": 1})
+    # Same sampling as the Ollama backend
+    sampling_params = SamplingParams(temperature=0.7, max_tokens=512)
+    return llm, sampling_params
+
+def get_captions_batch(img_paths: list[str]) -> list[Optional[str]]:
+    """Caption a batch of images in a single generate call, one output per input path.
+
+    Images that cannot be read get None, so one bad file does not fail the batch.
+    """
+    llm, sampling_params = _load_model()
+    prompt = _PROMPT_TEMPLATE.format(prompt=PROMPT)
+
+    inputs = []
+    readable = []
+    for i, img_path in enumerate(img_paths):
+        try:
+            # Same upright, size-capped RGB pixels the Ollama backend sends
+            with Image.open(img_path) as img:
+                image = prepare_image(img)
+        except Exception as e:
+            print(f"❌ Error reading {img_path}: {e}")
+            continue
+        inputs.append({"prompt": prompt, "multi_modal_data": {"image": image}})
+        readable.append(i)
+
+    captions: list[Optional[str]] = [None] * len(img_paths)
+    if inputs:
+        outputs = llm.generate(inputs, sampling_params=sampling_params)
+        for i, output in zip(readable, outputs):
+            captions[i] = output.outputs[0].text
+    return captions
@@ -1,15 +1,23 @@
 from core.utils import *
 import os
 import argparse
+import contextlib
 from pathlib import Path
 from core.ollama_service import check_ollama_status
 from core.cache_manager import CaptionCache
 
+def positive_int(value: str) -> int:
+    """argparse type for options that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description="Image Captioning with Qwen2.5-VL")
     parser.add_argument("--process-amount", type=int, default=None, 
                        help="Number of images to process (None = all)")
-    parser.add_argument("--workers", type=int, default=4, 
+    parser.add_argument("--workers", type=positive_int, default=4, 
                        help="Number of parallel workers")
     parser.add_argument("--use-cache", action="store_true", 
                        help="Use caching to skip already processed images")
@@ -19,16 +27,21 @@ def main():
                        help="Clear cache before processing")
     parser.add_argument("--num-demos", type=int, default=1,
                        help="Number of demo visualizations to generate")
+    parser.add_argument("--backend", choices=["ollama", "vllm"], default="ollama",
+                       help="Inference backend (vllm batches images in-process on the GPU)")
+    parser.add_argument("--batch-size", type=positive_int, default=8,
+                       help="Images per forward pass with --backend vllm")
     
     args = parser.parse_args()
     
-    # Check Ollama status first
-    print("🔍 Checking Ollama status...")
-    is_ready, message = check_ollama_status()
-    if not is_ready:
-        print(f"❌ {message}")
-        return 1
-    print(f"✅ {message}")
+    # Check Ollama status first (the vLLM backend runs in-process)
+    if args.backend == "ollama":
+        print("🔍 Checking Ollama status...")
+        is_ready, message = check_ollama_status()
+        if not is_ready:
+            print(f"❌ {message}")
+            return 1
+        print(f"✅ {message}")
     
     # Setup directories
     data_dir = "data/source"
@@ -36,8 +49,8 @@ def main():
     Path(caption_dir).mkdir(parents=True, exist_ok=True)
     
     # Handle cache clearing
+    cache = CaptionCache() if (args.use_cache or args.clear_cache) else None
     if args.clear_cache:
-        cache = CaptionCache()
         cache.clear()
     
     # Check for images
@@ -48,46 +61,59 @@ def main():
     
     # Get image files
     all_images = get_image_files(data_dir)
+    image_index = index_images(all_images, data_dir)
     if args.process_amount:
         all_images = all_images[:args.process_amount]
     
     print(f"📸 Found {len(all_images)} images to process")
     
     # Check existing captions
-    if not os.path.exists(caption_dir) or not os.listdir(caption_dir):
+    existing_captions = get_caption_stems(caption_dir)
+    if not existing_captions:
         print("🔄 No existing captions found, processing all images...")
         images_to_process = all_images
     else:
-        existing_captions = {f.split('.')[0] for f in os.listdir(caption_dir) if f.endswith('.json')}
-        images_to_process = [img for img in all_images if img.split('.')[0] not in existing_captions]
+        images_to_process = [img for img in all_images if os.path.splitext(img)[0] not in existing_captions]
         
         if images_to_process:
             print(f"📊 Found {len(existing_captions)} existing captions, {len(images_to_process)} new to process")
         else:
             print("✅ All images already have captions!")
     
-    # Process images
+    # Process images (cache metadata is flushed once when the batch finishes)
     if images_to_process:
-        if args.parallel:
-            print(f"🚀 Using parallel processing with {args.workers} workers")
-            results = map_captions_parallel(images_to_process, data_dir, max_workers=args.workers)
-        else:
-            print("🔄 Using sequential processing")
-            map_captions(images_to_process, root=data_dir)
+        # Only images about to be captioned are stat'd; the results are reused downstream
+        image_stats = stat_images(images_to_process, data_dir)
+        with cache or contextlib.nullcontext():
+            caption_cache = cache if args.use_cache else None
+            if args.backend == "vllm":
+                print(f"🚀 Using in-process vLLM with batch size {args.batch_size}")
+                results = map_captions_batched(images_to_process, data_dir, batch_size=args.batch_size,
+                                               cache=caption_cache, stats=image_stats)
+            elif args.parallel:
+                print(f"🚀 Using parallel processing with {args.workers} workers")
+                results = map_captions_parallel(images_to_process, data_dir, max_workers=args.workers,
+                                                cache=caption_cache, stats=image_stats)
+            else:
+                print("🔄 Using sequential processing")
+                map_captions(images_to_process, root=data_dir, cache=caption_cache, stats=image_stats)
     
     # Generate demo
     print("\n🎨 Generating demo...")
     if args.num_demos > 1:
-        make_multiple_demos(data_dir=data_dir, caption_dir=caption_dir, num_demos=args.num_demos)
+        make_multiple_demos(data_dir=data_dir, caption_dir=caption_dir, num_demos=args.num_demos,
+                            image_index=image_index)
     else:
-        make_demo(data_dir=data_dir, caption_dir=caption_dir)
+        make_demo(data_dir=data_dir, caption_dir=caption_dir, image_index=image_index)
     
     # Show cache stats if using cache
     if args.use_cache:
-        cache = CaptionCache()
         stats = cache.stats()
         print(f"\n💾 Cache stats: {stats['cached_items']} items, {stats['total_size_mb']:.1f}MB")
     
+    if cache is not None:
+        cache.close()
+    
     print("✅ Processing complete!")
 
 if __name__ == "__main__":